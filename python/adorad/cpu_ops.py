@@ -1,32 +1,39 @@
 import numpy as np
-from .tensor import register, Tensor
-import inspect 
+from .tensor import register, Tensor, Device, _rng
 #pylint:disable=no-member,too-many-function-args,not-callable
 
 # An instantiation of the Function is the Context
 class Function:
+    # dispatch only overrides this for non-CPU devices
+    device = Device.CPU
+    # forward's defaulted params, collected once by register
+    defaults = {}
+
     def __init__(self, *tensors):
         self.parents = tensors
         self.saved_tensors = []
+        # with no input needing a grad (or under Tensor.no_grad()) there is no graph to keep
+        self.requires_grad = Tensor.grad_enabled and any(t.requires_grad for t in tensors)
 
     def save_for_backward(self, *x):
-        self.saved_tensors.extend(x)
+        if self.requires_grad:
+            self.saved_tensors.extend(x)
 
     def apply(self, *x, **kwargs):
         ctx = self(*x) # self - operation i.e 'add', 'sub', etc.
-        # use default params
-        params = inspect.signature(self.forward).parameters
-        for p in params.values():
-          if p.default is not p.empty:
-            setattr(ctx, p.name, p.default)
-        # overwrite with passed params
-        for k, v in kwargs.items():
-          setattr(ctx, k, v)
-
-        if ret.requires_grad:
+        # use default params, then overwrite with passed params
+        ctx.__dict__.update(self.defaults)
+        ctx.__dict__.update(kwargs)
+
+        ret = Tensor(self.forward(ctx, *[t.data for t in x], **kwargs), device=ctx.device, requires_grad=ctx.requires_grad)
+        if ctx.requires_grad:
           ret._ctx = ctx
         return ret
 
+# dtype of the output buffer for ops that compute in place; integers promote to float like np.exp would
+def float_dtype(x):
+    return np.result_type(x, np.float32)
+
 # ************* unary ops *************
 
 class ReLU(Function):
@@ -65,6 +72,201 @@ class Exp(Function):
         return grad_output * ret
 
 
+class Abs(Function):
+    @staticmethod
+    def forward(ctx, input):
+        ctx.save_for_backward(input)
+        return np.abs(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        return grad_output * np.sign(input)
+
+
+class Sign(Function):
+    @staticmethod
+    def forward(ctx, input):
+        return np.sign(input)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # piecewise constant, subgradient 0 everywhere (including at 0)
+        return np.zeros_like(grad_output)
+
+
+class Sqrt(Function):
+    @staticmethod
+    def forward(ctx, input):
+        ret = np.sqrt(input)
+        ctx.save_for_backward(ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ret, = ctx.saved_tensors
+        return grad_output * 0.5 / ret
+
+
+class Reciprocal(Function):
+    @staticmethod
+    def forward(ctx, input):
+        ret = np.reciprocal(input, dtype=float_dtype(input))
+        ctx.save_for_backward(ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ret, = ctx.saved_tensors
+        return -grad_output * ret * ret
+
+
+class Sigmoid(Function):
+    @staticmethod
+    def forward(ctx, input):
+        # 1/(1+exp(-x)) computed in place in a single output buffer
+        ret = np.negative(input, dtype=float_dtype(input))
+        np.exp(ret, out=ret)
+        ret += 1
+        np.reciprocal(ret, out=ret)
+        ctx.save_for_backward(ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ret, = ctx.saved_tensors
+        return grad_output * ret * (1 - ret)
+
+
+class Tanh(Function):
+    @staticmethod
+    def forward(ctx, input):
+        ret = np.tanh(input)
+        ctx.save_for_backward(ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ret, = ctx.saved_tensors
+        return grad_output * (1 - ret * ret)
+
+
+class ReLU6(Function):
+    @staticmethod
+    def forward(ctx, input):
+        ctx.save_for_backward(input)
+        return np.clip(input, 0, 6)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        return grad_output * ((input >= 0) & (input < 6))
+
+
+class LeakyReLU(Function):
+    @staticmethod
+    def forward(ctx, input, neg_slope=0.01):
+        ctx.save_for_backward(input)
+        return np.where(input >= 0, input, input * neg_slope)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        return np.where(input >= 0, grad_output, grad_output * ctx.neg_slope)
+
+
+class HardSwish(Function):
+    @staticmethod
+    def forward(ctx, input):
+        # x * relu6(x+3) / 6 in a single output buffer
+        ret = np.add(input, 3, dtype=float_dtype(input))
+        np.clip(ret, 0, 6, out=ret)
+        ret *= input
+        ret /= 6
+        ctx.save_for_backward(input)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        return grad_output * (np.clip(input + 3, 0, 6) + input * ((input >= -3) & (input < 3))) / 6
+
+
+class Softplus(Function):
+    @staticmethod
+    def forward(ctx, input, limit=20, beta=1):
+        # 1/beta*log(1 + exp(beta*x)); logaddexp never overflows, so `limit` needs no special case
+        ret = np.multiply(input, beta, dtype=float_dtype(input))
+        np.logaddexp(0, ret, out=ret)
+        ret /= beta
+        ctx.save_for_backward(input)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, = ctx.saved_tensors
+        # d/dx = sigmoid(beta*x)
+        den = np.multiply(input, -ctx.beta, dtype=float_dtype(input))
+        np.exp(den, out=den)
+        den += 1
+        return grad_output / den
+
+
+class Dropout(Function):
+    @staticmethod
+    def forward(ctx, input, p=0.5):
+        if not Tensor.training:
+            ctx.save_for_backward(None, 1.0)
+            return input
+        # bool keep-mask: 1 byte/element, reused as-is by backward
+        mask = _rng.random(input.shape, dtype=np.float32) >= p
+        scale = 1.0/(1.0 - p)
+        ret = np.multiply(input, mask, dtype=float_dtype(input))
+        ret *= scale
+        ctx.save_for_backward(mask, scale)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        mask, scale = ctx.saved_tensors
+        if mask is None:
+            return grad_output
+        ret = np.multiply(grad_output, mask)
+        ret *= scale
+        return ret
+
+
+class Softmax(Function):
+    @staticmethod
+    def forward(ctx, input):
+        # one max pass, then exp/normalize in place over the last axis
+        ret = np.subtract(input, input.max(axis=-1, keepdims=True), dtype=float_dtype(input))
+        np.exp(ret, out=ret)
+        ret /= ret.sum(axis=-1, keepdims=True)
+        ctx.save_for_backward(ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ret, = ctx.saved_tensors
+        gy = grad_output * ret
+        return gy - ret * gy.sum(axis=-1, keepdims=True)
+
+
+class LogSoftmax(Function):
+    @staticmethod
+    def forward(ctx, input):
+        ret = np.subtract(input, input.max(axis=-1, keepdims=True), dtype=float_dtype(input))
+        ret -= np.log(np.exp(ret).sum(axis=-1, keepdims=True))
+        ctx.save_for_backward(ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        ret, = ctx.saved_tensors
+        return grad_output - np.exp(ret) * grad_output.sum(axis=-1, keepdims=True)
+
+
 # ************* reduce ops *************
 
 class Sum(Function):
@@ -80,6 +282,20 @@ class Sum(Function):
         shape = [1 if axis is None or i in axis else input.shape[i] for i in range(len(input.shape))]
         return grad_output.reshape(shape) + np.zeros_like(input)
 
+class Mean(Function):
+    @staticmethod
+    def forward(ctx, input, axis=None):
+        ret = np.array([input.mean()]) if axis is None else input.mean(axis=axis)
+        ctx.save_for_backward(input.shape, axis, input.size // ret.size)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        in_shape, axis, count = ctx.saved_tensors
+        axis = [axis] if type(axis) is int else axis
+        shape = [1 if axis is None or i in axis else in_shape[i] for i in range(len(in_shape))]
+        return np.broadcast_to(grad_output.reshape(shape) / count, in_shape).copy()
+
 class Max(Function):
     @staticmethod
     def forward(ctx, inp, axis=None):
@@ -150,6 +366,38 @@ class Pow(Function):
         return unbroadcast(y * (x**(y-1.0)) * grad_output, x.shape), \
             unbroadcast((x**y) * np.log(x) * grad_output, y.shape)
 
+# ************* scalar ops *************
+# `tensor <op> number` is routed here by dispatch, so the number never gets boxed into a Tensor
+
+class AddScalar(Function):
+    @staticmethod
+    def forward(ctx, x, c):
+        return x + c
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output
+
+class MulScalar(Function):
+    @staticmethod
+    def forward(ctx, x, c):
+        return x * c
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return grad_output * ctx.c
+
+class PowScalar(Function):
+    @staticmethod
+    def forward(ctx, x, c):
+        ctx.save_for_backward(x)
+        return x ** c
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        return ctx.c * (x ** (ctx.c - 1)) * grad_output
+
 # ************* movement ops *************
 
 class Reshape(Function):
@@ -175,7 +423,9 @@ class Transpose(Function):
 
 def inner_slice(x, arg):
     padding = [(max(0, -p[0]), max(0, p[1]-x.shape[i])) for i,p in enumerate(arg)]
-    x = np.pad(x, padding)
+    # in-bounds slices (the common case) stay a view of x; np.pad would always copy
+    if any(p[0] or p[1] for p in padding):
+        x = np.pad(x, padding)
     slicee = [(p[0] + padding[i][0], p[1] + padding[i][0]) for i,p in enumerate(arg)]
     return x[tuple([slice(x[0], x[1], None) for x in slicee])]
 
@@ -207,6 +457,57 @@ class Matmul(Function):
         grad_weight = np.swapaxes(input, -2, -1) @ grad_output
         return grad_input, grad_weight
 
+def pool2d_windows(shape, py, px):
+    # one strided slice per offset inside the window; together they cover the cropped input once
+    oy, ox = shape[2]//py, shape[3]//px
+    return [(slice(None), slice(None), slice(i, oy*py, py), slice(j, ox*px, px)) for i in range(py) for j in range(px)]
+
+class AvgPool2D(Function):
+    @staticmethod
+    def forward(ctx, x, kernel_size=(2,2)):
+        ctx.save_for_backward(x.shape)
+        windows = pool2d_windows(x.shape, *kernel_size)
+        # accumulate straight into an output-sized buffer, no 6-D intermediate
+        ret = x[windows[0]].astype(float_dtype(x))
+        for w in windows[1:]:
+            ret += x[w]
+        ret /= len(windows)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        shape, = ctx.saved_tensors
+        windows = pool2d_windows(shape, *ctx.kernel_size)
+        g = grad_output / len(windows)
+        # cropped edges get zero
+        ret = np.zeros(shape, dtype=g.dtype)
+        for w in windows:
+            ret[w] = g
+        return ret
+
+class MaxPool2D(Function):
+    @staticmethod
+    def forward(ctx, x, kernel_size=(2,2)):
+        windows = pool2d_windows(x.shape, *kernel_size)
+        ret = x[windows[0]].copy()
+        for w in windows[1:]:
+            np.maximum(ret, x[w], out=ret)
+        # backward recomputes the argmax from x, so no input-sized mask is kept
+        ctx.save_for_backward(x, ret)
+        return ret
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, ret = ctx.saved_tensors
+        windows = pool2d_windows(x.shape, *ctx.kernel_size)
+        # ties share the gradient, same as Max
+        div = sum(x[w] == ret for w in windows)
+        g = grad_output / div
+        out = np.zeros(x.shape, dtype=g.dtype)
+        for w in windows:
+            out[w] = (x[w] == ret) * g
+        return out
+
 class Conv2D(Function):
     @staticmethod
     def forward(ctx, x, w, stride=1, groups=1):
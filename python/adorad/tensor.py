@@ -2,27 +2,40 @@ import os
 import numpy as np 
 import sys
 import inspect
-import functools
+import importlib.util
+import contextlib
 from collections import defaultdict
 #pylint:disable=no-member,too-many-function-args
 
 class Device: CPU, GPU = 0, 1
-DEFAULT_DEVICE = Device.CPU if os.environ.get('GPU', 0) !=1 else Device.GPU 
+DEFAULT_DEVICE = Device.GPU if os.environ.get('GPU', '0') == '1' else Device.CPU
+
+# pyopencl is only imported when the GPU was asked for. The GPU ops themselves need Tensor, so
+# they're imported at the bottom; only check here that they exist, so GPU is settled before registration
+cl, GPU = None, False
+if DEFAULT_DEVICE == Device.GPU:
+    try:
+        import pyopencl as cl
+        if importlib.util.find_spec(".ops.gpu", __package__) is None:
+            raise ImportError("no GPU ops")
+        GPU = True
+    except ImportError:
+        # no GPU support
+        cl = None
+        DEFAULT_DEVICE = Device.CPU
 
-try:
-    import pyopencl as cl
-    # TODO: move this import to require_init_gpu?
-    from .ops import gpu
-    _register_ops(gpu, device=Device.GPU)
-    GPU = True
-except ImportError:
-    # no GPU support
-    cl = None 
-    GPU = False
+
+# draws float32 directly instead of casting down from float64; shared by every random op, see Tensor.manual_seed
+_rng = np.random.default_rng()
 
 
 class Tensor:
+    # no per-instance __dict__; `training`, `grad_enabled`, `ops` and the registered ops stay class attributes
+    __slots__ = ('data', 'device', 'requires_grad', '_grad_data', '_grad', '_ctx', '_topo')
+
     training = True 
+    # off skips graph building (and saving tensors for backward); prefer `with Tensor.no_grad():`
+    grad_enabled = True
     ops = defaultdict(dict)
 
     def __init__(self, data, device=DEFAULT_DEVICE, requires_grad=True):
@@ -31,6 +44,14 @@ class Tensor:
     
         self.data = self._move_data(data, device)
         self.device = device 
+        self.requires_grad = requires_grad
+        # raw ndarray gradient and its cached Tensor wrapper, see the `grad` property
+        self._grad_data = None
+        self._grad = None
+        # the Function that produced this Tensor, if any
+        self._ctx = None
+        # (ctx, nodes) memo of the last deepwalk from this Tensor
+        self._topo = None
 
     def __repr__(self):
         return f"<hazel.Tensor {self.data!r}>"
@@ -45,10 +66,42 @@ class Tensor:
     @property
     def dtype(self):
         return self.data.dtype
+
+    @property
+    def grad(self):
+        # backward() accumulates plain ndarrays; the Tensor wrapper is built on first access and
+        # kept until the gradient is replaced, so writes through it (assign, to_) stick
+        if self._grad is None and self._grad_data is not None:
+            self._grad = Tensor(self._grad_data, device=self.device, requires_grad=False)
+        return self._grad
+
+    @grad.setter
+    def grad(self, x):
+        self._grad_data = None if x is None else x.data if isinstance(x, Tensor) else np.asarray(x)
+        self._grad = None
+
+    def _grad_array(self):
+        # a wrapper handed out by `grad` may have been assigned to since, its data wins
+        return self._grad_data if self._grad is None else self._grad.data
     
 
+    @classmethod
+    @contextlib.contextmanager
+    def no_grad(cls):
+        prev, cls.grad_enabled = cls.grad_enabled, False
+        try:
+            yield
+        finally:
+            cls.grad_enabled = prev
+
+
     # ***** creation functions *****
 
+    @staticmethod
+    def manual_seed(seed):
+        # reseeds the shared generator in place, so modules holding a reference see the new stream
+        _rng.bit_generator.state = type(_rng.bit_generator)(seed).state
+
     @classmethod
     def zeros(cls, *shape, **kwargs):
         return cls(np.zeros(shape, dtype=np.float32), **kwargs)
@@ -59,23 +112,43 @@ class Tensor:
 
     @classmethod
     def randn(cls, *shape, **kwargs):
-        return cls(np.random.randn(*shape).astype(np.float32), **kwargs)
+        return cls(_rng.standard_normal(shape, dtype=np.float32), **kwargs)
 
     @classmethod
     def uniform(cls, *shape, **kwargs):
-        return cls((np.random.uniform(-1., 1., size=shape)/np.sqrt(np.prod(shape))).astype(np.float32), **kwargs)
+        # U(-1, 1)/sqrt(N) from a U(0, 1) float32 draw, scaled in place
+        scale = np.float32(1.0/np.sqrt(np.prod(shape)))
+        ret = _rng.random(shape, dtype=np.float32)
+        ret *= 2*scale
+        ret -= scale
+        return cls(ret, **kwargs)
 
     @classmethod
     def eye(cls, dim, **kwargs):
-        return cls(np.eye(dim).astype(np.float32), **kwargs)
+        return cls(np.eye(dim, dtype=np.float32), **kwargs)
 
 
     # ***** toposort and backward pass *****
-    def deepwalk(self, visited: set, nodes: list):
-        visited.add(self)
-        if self._ctx:
-            [i.deepwalk(visited, nodes) for i in self._ctx.parents if i not in visited]
-            nodes.append(self)
+    def deepwalk(self):
+        # iterative post-order DFS; parents always come before their children in `nodes`
+        if self._topo is not None and self._topo[0] is self._ctx:
+            return self._topo[1]
+
+        visited, nodes = set(), []
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                nodes.append(node)
+                continue
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            if node._ctx:
+                stack.append((node, True))
+                stack.extend((i, False) for i in node._ctx.parents if id(i) not in visited)
+
+        self._topo = (self._ctx, nodes)
         return nodes
 
 
@@ -84,20 +157,22 @@ class Tensor:
 
         # fill in the first grad with one
         # this is "implicit gradient creation"
-        self.grad = Tensor(np.ones(self.shape, dtype=self.dtype), device=self.device, requires_grad=False)
-
-        for t0 in reversed(self.deepwalk(set(), [])):
-            assert (t0.grad is not None)
-
-        if len(t0._ctx.parents) == 1:
-            grads = [grads]
-
-        for t, g in zip(t0._ctx.parents, grads):
-            if g is not None:
-                assert g.shape == t.shape, \
-                    f"grad shape must match tensor shape in {self._ctx!r}, {g.shape!r} != {t.shape!r}"
-                gt = Tensor(g, device=self.device, requires_grad=False)
-                t.grad = gt if t.grad is None else (t.grad + gt)
+        self.grad = np.ones(self.shape, dtype=self.dtype)
+
+        for t0 in reversed(self.deepwalk()):
+            grad = t0._grad_array()
+            assert (grad is not None)
+            grads = t0._ctx.backward(t0._ctx, grad)
+            if len(t0._ctx.parents) == 1:
+                grads = [grads]
+
+            for t, g in zip(t0._ctx.parents, grads):
+                if g is not None:
+                    assert g.shape == t.shape, \
+                        f"grad shape must match tensor shape in {t0._ctx!r}, {g.shape!r} != {t.shape!r}"
+                    # g may alias another node's grad, so accumulate out of place
+                    prev = t._grad_array()
+                    t._grad_data, t._grad = (g if prev is None else prev + g), None
 
     # ***** hazel supports only CPU *****
 
@@ -106,16 +181,28 @@ class Tensor:
         return data
 
     def to_(self, device):
+        if device == self.device:
+            return self
+
         self.data = self._move_data(self.data, device)
         self.device = device
 
-        if self.grad: 
-            self.grad.to_(device)
+        grad = self._grad_array()
+        if grad is not None:
+            self.grad = self._move_data(grad, device)
+        return self
 
     def to(self, device):
-        ret = Tensor(self.data, device)
-        if self.grad: 
-            ret.grad = self.grad.to(device)
+        if device == self.device:
+            # same device: share the buffers, nothing to move
+            ret = Tensor(self.data, device, requires_grad=self.requires_grad)
+            ret._grad_data = self._grad_array()
+            return ret
+
+        ret = Tensor(self.data, device, requires_grad=self.requires_grad)
+        grad = self._grad_array()
+        if grad is not None:
+            ret._grad_data = self._move_data(grad, device)
 
         return ret
 
@@ -144,109 +231,86 @@ class Tensor:
         return self.matmul(w)
 
 
-    def mean(self, axis=None):
-        out = self.sum(axis=axis)
-        return out * (np.prod(out.shape)/np.prod(self.shape))
-
-
-    def sqrt(self):
-        return self.pow(0.5)
-
-
     def div(self, y):
-        return self * (y ** -1.0)
+        return self * (y.reciprocal() if isinstance(y, Tensor) else 1.0/y)
     __truediv__ = div
 
 
-    def sigmoid(self):
-        e = self.exp()
-        return e.div(1 + e)
-
-
     def swish(self):
         return self * self.sigmoid()
 
 
-    def relu6(self):
-        return self.relu() - (self-6).relu()
-
-
-    def hardswish(self):
-        return self * (self+3).relu6() * (1/6)
-
-
-    def tanh(self):
-        return 2.0 * ((2.0 * self).sigmoid()) - 1.0
-
-
-    def leakyrelu(self, neg_slope=0.01):
-        return self.relu() - (-neg_slope*self).relu()
-
-
-    def softmax(self):
-        ns = list(self.shape)[:-1]+[1]
-        m = self.max(axis=len(self.shape)-1).reshape(shape=ns)
-        e = (self - m).exp()
-        ss = e.sum(axis=len(self.shape)-1).reshape(shape=ns)
-        return e.div(ss)
-
-
-    def logsoftmax(self):
-        ns = list(self.shape)[:-1]+[1]
-        m = self.max(axis=len(self.shape)-1).reshape(shape=ns)
-        ss = m + (self-m).exp().sum(axis=len(self.shape)-1).reshape(shape=ns).log()
-        return self - ss
-
-
-    def dropout(self, p=0.5):
-        # TODO: this needs a test
-        if Tensor.training:
-            _mask = np.asarray(np.random.binomial(1, 1.0-p, size=self.shape), dtype=self.dtype)
-            return self * Tensor(_mask, requires_grad=False, device=self.device) * (1/(1.0 - p))
-        else:
-            return self
-
-
-    def softplus(self, limit=20, beta=1):
-        # safe softplus - 1/beta*log(1 + exp(beta*x)) (PyTorch)
-        eb = (self*beta).exp()
-        ret = (1 + eb).log()
-        return (1/beta)*ret
-
-
     def mish(self):
         return self * (self.softplus().tanh()) # x*tanh(softplus(x))
 
 
-    def abs(self):
-        return self.relu() + (-1.0*self).relu()
-
-
-    def sign(self):
-        return self / (self.abs() + 1e-10)
-
-
-    def _pool2d(self, py, px):
-        xup = self[:, :, :self.shape[2]-self.shape[2]%py, :self.shape[3]-self.shape[3]%px]
-        return xup.reshape(shape=(xup.shape[0], xup.shape[1], xup.shape[2]//py, py, xup.shape[3]//px, px))
-
-
     def avg_pool2d(self, kernel_size=(2,2)):
-        return self._pool2d(*kernel_size).mean(axis=(3,5))
+        return self.avgpool2d(kernel_size=kernel_size)
 
 
     def max_pool2d(self, kernel_size=(2,2)):
-        return self._pool2d(*kernel_size).max(axis=(3,5))
+        return self.maxpool2d(kernel_size=kernel_size)
+
+# maps `tensor <op> number` onto the matching `<op>scalar` op as (name, tensor, number)
+def _scalar_route(name, x, y):
+    t, c = (x, y) if isinstance(x, Tensor) else (y, x)
+    if not isinstance(c, (int, float, np.number)):
+        return None
+    if t is x and name == 'sub':
+        # x - c as x + (-c); -c has no unsigned representation, those stay on the boxed Sub path
+        if t.dtype.kind == 'u':
+            return None
+        return 'addscalar', t, t.dtype.type(-c)
+    # same cast the boxed path does, so e.g. a np.float64 can't upcast a float32 result
+    c = t.dtype.type(c)
+    if name in ('add', 'mul') or (t is x and name == 'pow'):
+        return f"{name}scalar", t, c
+    return None
 
 cl_ctx, cl_queue = None, None
 def register(name, fxn, device=Device.CPU):
     Tensor.ops[device][name] = fxn
 
+    # signature work happens once here, not on every apply
+    params = list(inspect.signature(fxn.forward).parameters.values())[1:]
+    fxn.defaults = {p.name: p.default for p in params if p.default is not p.empty}
+    n_inputs = len(params) - len(fxn.defaults)
+    # positional args past the inputs bind to the defaulted params in order, e.g. t.mean(1), t.dropout(0.3)
+    options = list(fxn.defaults)
+
+    # ops whose forward takes a single input need no Tensor lookup, scalar boxing
+    # or device resolution on a CPU-only build
+    if not GPU and device == Device.CPU and n_inputs == 1:
+        def dispatch(x, *args, **kwargs):
+            if args:
+                kwargs.update(zip(options, args))
+            return fxn.apply(fxn, x, **kwargs)
+        setattr(Tensor, name, dispatch)
+        return
+
     def dispatch(*x, **kwargs):
-        tt = [arg for arg in x if isinstance(arg, Tensor)][0]
-        x = [Tensor(np.array([arg], dtype=tt.dtype), device=tt.device, requires_grad=False) if not isinstance(arg, Tensor) else arg for arg in x]
-        f = Tensor.ops[tt.device][name]
-        f.cl_ctx, f.cl_queue, f.device = cl_ctx, cl_queue, tt.device
+        if len(x) > n_inputs:
+            kwargs.update(zip(options, x[n_inputs:]))
+            x = x[:n_inputs]
+
+        # single pass: find the first Tensor and note whether any scalar needs boxing
+        tt, scalar = None, False
+        for arg in x:
+            if not isinstance(arg, Tensor):
+                scalar = True
+            elif tt is None:
+                tt = arg
+
+        f = fxn if tt.device == device else Tensor.ops[tt.device][name]
+        if scalar:
+            route = _scalar_route(name, *x) if len(x) == 2 else None
+            if route is not None and route[0] in Tensor.ops[tt.device]:
+                f, x, kwargs = Tensor.ops[tt.device][route[0]], route[1:2], {'c': route[2]}
+            else:
+                x = [Tensor(np.array([arg], dtype=tt.dtype), device=tt.device, requires_grad=False) if not isinstance(arg, Tensor) else arg for arg in x]
+
+        if tt.device != Device.CPU:
+            f.cl_ctx, f.cl_queue, f.device = cl_ctx, cl_queue, tt.device
         return f.apply(f, *x, **kwargs)
     setattr(Tensor, name, dispatch)
 
@@ -255,15 +319,37 @@ def register(name, fxn, device=Device.CPU):
         setattr(Tensor, f"__i{name}__", lambda self,x: self.assign(dispatch(self,x)))
         setattr(Tensor, f"__r{name}__", lambda self,x: dispatch(x,self))
 
-for device in [device for device in Device.__dict__.keys() if device[0] != "_"]:
-    setattr(Tensor, f"{device.lower()}", functools.partialmethod(Tensor.to, Device.__dict__[device]))
-    setattr(Tensor, f"{device.lower()}_", functools.partialmethod(Tensor.to_, Device.__dict__[device]))
+# plain functions per device (Tensor.cpu, Tensor.cpu_, ...), cheaper to call than a partialmethod
+def _device_methods(device):
+    def to(self):
+        return self.to(device)
+
+    def to_(self):
+        return self.to_(device)
+    return to, to_
+
+def _register_devices():
+    for name, device in list(vars(Device).items()):
+        if name[0] == "_" or (device == Device.GPU and not GPU):
+            continue
+        to, to_ = _device_methods(device)
+        setattr(Tensor, name.lower(), to)
+        setattr(Tensor, f"{name.lower()}_", to_)
+
+_register_devices()
 
 # This registers all the operations
 def _register_ops(namespace, device=Device.CPU):
-    for name, cls in inspect.getmembers(namespace, inspect.isclass):
-        if name[0] != "_":  register(name.lower(), cls, device=device)
+    # a plain __dict__ scan; anything that implements `forward` is an op
+    for name, cls in list(vars(namespace).items()):
+        if name[0] != "_" and isinstance(cls, type) and hasattr(cls, "forward"):
+            register(name.lower(), cls, device=device)
 
 
-from hazel import cpu_ops
+from . import cpu_ops
 _register_ops(cpu_ops)
+
+if GPU:
+    # TODO: move this import to require_init_gpu?
+    from .ops import gpu
+    _register_ops(gpu, device=Device.GPU)